@@ -10,7 +10,7 @@ import textwrap
 from timing import monotonic_time_nanos
 from tracing import Tracing
 from buck_tool import BuckTool, check_output, JAVA_MAX_HEAP_SIZE_MB
-from buck_tool import BuckToolException, RestartBuck
+from buck_tool import BuckToolException, RestartBuck, platform_path
 from subprocutils import which
 import buck_version
 
@@ -140,7 +140,7 @@ class BuckRepo(BuckTool):
     def __init__(self, buck_bin_dir, buck_project):
         super(BuckRepo, self).__init__(buck_project)
 
-        self._buck_dir = self._platform_path(os.path.dirname(buck_bin_dir))
+        self._buck_dir = platform_path(os.path.dirname(buck_bin_dir))
         self._build_success_file = os.path.join(
             self._buck_dir, "build", "successful-build")
 
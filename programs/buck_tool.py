@@ -1,34 +1,72 @@
 from __future__ import print_function
+# Modules needed only on rare paths (error reporting, the daemon-busy retry,
+# the SIGUSR1 handler) are imported where they are used, to keep startup fast.
 import errno
-import json
+import itertools
 import os
 import platform
-import re
 import shlex
 import signal
+import socket
 import subprocess
 import sys
-import tempfile
-import textwrap
 import time
-import traceback
-import uuid
 
+from path_watch import PathWatcher
 from pynailgun import NailgunConnection, NailgunException
-from timing import monotonic_time_nanos
+from timing import monotonic_time_nanos, NSEC_PER_MSEC, NSEC_PER_SEC
 from tracing import Tracing
 from subprocutils import check_output, CalledProcessError, which
-from sys import platform as os_platform
 
 BUCKD_CLIENT_TIMEOUT_MILLIS = 60000
 GC_MAX_PAUSE_TARGET = 15000
 
+# How long to wait for a freshly launched buckd to create its socket.
+BUCKD_SOCKET_TIMEOUT_SECONDS = 3.0
+
 JAVA_MAX_HEAP_SIZE_MB = 1000
 
 # While waiting for the daemon to terminate, print a message at most
 # every DAEMON_BUSY_MESSAGE_SECONDS seconds.
 DAEMON_BUSY_MESSAGE_SECONDS = 1.0
 
+# While the daemon is busy, retry after this long, doubling the delay on each
+# attempt up to DAEMON_BUSY_MESSAGE_SECONDS.
+DAEMON_BUSY_INITIAL_BACKOFF_SECONDS = 0.05
+
+# Settings read from the environment, which is fixed for the lifetime of the
+# process as far as these are concerned.
+_NO_BUCKD = bool(os.environ.get('NO_BUCKD'))
+_BUCK_DEBUG_MODE = bool(os.environ.get('BUCK_DEBUG_MODE'))
+_BUCK_DEBUG_SOY = bool(os.environ.get('BUCK_DEBUG_SOY'))
+_BUCK_EXTRA_JAVA_ARGS = os.environ.get('BUCK_EXTRA_JAVA_ARGS') or ''
+
+_which_cache = {}
+
+
+# Looks up an executable on $PATH, remembering the result for the lifetime of
+# the process since the same few executables are looked up repeatedly.
+def _cached_which(name):
+    if name not in _which_cache:
+        _which_cache[name] = which(name)
+    return _which_cache[name]
+
+
+# Converts a path to the form the JVM expects.  Only cygwin needs any
+# conversion, which shells out to cygpath, so its results are remembered.
+if sys.platform == 'cygwin':
+    _platform_path_cache = {}
+
+    def platform_path(path):
+        if path not in _platform_path_cache:
+            _platform_path_cache[path] = subprocess.check_output(
+                ['cygpath', '-w', path]).strip()
+        return _platform_path_cache[path]
+else:
+    def platform_path(path):
+        return path
+
+
 # Describes a resource used by this driver.
 #  - name: logical name of the resources
 #  - executable: whether the resource should/needs execute permissions
@@ -64,27 +102,47 @@ EXPORTED_RESOURCES = [
 ]
 
 
+# Size of the send/receive buffers of the socket used to talk to buckd; large
+# enough that a whole command (arguments and environment) goes out in one write.
+NAILGUN_SOCKET_BUFFER_BYTES = 1 << 20
+
+
+class _FastNailgunConnection(NailgunConnection):
+    '''NailgunConnection tuned for the many small frames exchanged with buckd.'''
+
+    def __init__(self, *args, **kwargs):
+        super(_FastNailgunConnection, self).__init__(*args, **kwargs)
+        try:
+            if self.socket.family in (socket.AF_INET, socket.AF_INET6):
+                # Don't let Nagle's algorithm hold back small frames.
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, NAILGUN_SOCKET_BUFFER_BYTES)
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, NAILGUN_SOCKET_BUFFER_BYTES)
+        except socket.error:
+            # These are only optimizations; the defaults work too.
+            pass
+
+
 class CommandLineArgs:
     def __init__(self, cmdline):
         self.args = cmdline[1:]
 
-        self.buck_options = []
-        self.command = None
-        self.command_options = []
+        # Everything up to the first non-option is an option to buck itself.
+        self.buck_options = list(itertools.takewhile(
+            lambda arg: arg.startswith("-"), self.args))
+        rest = self.args[len(self.buck_options):]
+        self.command = rest[0] if rest else None
+        self.command_options = rest[1:]
 
-        for arg in self.args:
-            if (self.command is not None):
-                self.command_options.append(arg)
-            elif (arg[:1]) == "-":
-                self.buck_options.append(arg)
-            else:
-                self.command = arg
+        self._is_help = self.command is None or "--help" in self.command_options
 
     # Whether this is a help command that doesn't run a build
     # n.b. 'buck --help clean' is *not* currently a help command
     # n.b. 'buck --version' *is* a help command
     def is_help(self):
-        return self.command is None or "--help" in self.command_options
+        return self._is_help
 
 
 class RestartBuck(Exception):
@@ -98,13 +156,19 @@ class BuckToolException(Exception):
 class BuckTool(object):
 
     def __init__(self, buck_project):
-        self._init_timestamp = int(round(time.time() * 1000))
+        self._init_timestamp_nanos = monotonic_time_nanos()
         self._command_line = CommandLineArgs(sys.argv)
         self._buck_project = buck_project
-        self._tmp_dir = self._platform_path(buck_project.tmp_dir)
+        self._tmp_dir = platform_path(buck_project.tmp_dir)
         self._stdout_file = os.path.join(self._tmp_dir, "stdout")
         self._stderr_file = os.path.join(self._tmp_dir, "stderr")
 
+        # Memoized results of the corresponding _get_* methods.
+        self._buck_version_uid = None
+        self._bootstrap_classpath = None
+        self._java_classpath = None
+        self._exported_resource_args = None
+
         self._pathsep = os.pathsep
         if (sys.platform == 'cygwin'):
             self._pathsep = ';'
@@ -124,13 +188,27 @@ class BuckTool(object):
         raise NotImplementedError()
 
     def _use_buckd(self):
-        return not os.environ.get('NO_BUCKD')
+        return not _NO_BUCKD
+
+    # Time spent in this script before handing off to Java, as a string for
+    # BUCK_PYTHON_SPACE_INIT_TIME.
+    def _python_space_init_time_millis(self):
+        return str((monotonic_time_nanos() - self._init_timestamp_nanos) // NSEC_PER_MSEC)
 
+    # The variables buck needs on top of the environment it inherits.
     def _environ_for_buck(self):
+        return {
+            'CLASSPATH': str(self._get_cached_bootstrap_classpath()),
+            'BUCK_CLASSPATH': str(self._get_cached_java_classpath()),
+            'BUCK_TTY': str(int(sys.stdin.isatty())),
+        }
+
+    # The complete environment to run buck with.  buckd sees only the
+    # environment sent with each command, so it needs all of it too.
+    def _full_environ_for_buck(self, **extra):
         env = os.environ.copy()
-        env['CLASSPATH'] = str(self._get_bootstrap_classpath())
-        env['BUCK_CLASSPATH'] = str(self._get_java_classpath())
-        env['BUCK_TTY'] = str(int(sys.stdin.isatty()))
+        env.update(self._environ_for_buck())
+        env.update(extra)
         return env
 
     def launch_buck(self, build_id):
@@ -138,18 +216,19 @@ class BuckTool(object):
             if self._command_line.command == "clean" and not self._command_line.is_help():
                 self.kill_buckd()
 
-            buck_version_uid = self._get_buck_version_uid()
-
             use_buckd = self._use_buckd()
+            buckd_connection = None
             if not self._command_line.is_help():
-                has_watchman = bool(which('watchman'))
+                has_watchman = bool(_cached_which('watchman'))
                 if use_buckd and has_watchman:
+                    buck_version_uid = self._get_cached_buck_version_uid()
                     running_version = self._buck_project.get_running_buckd_version()
 
                     if (running_version != buck_version_uid):
                         self.kill_buckd()
 
-                    if not self._is_buckd_running():
+                    buckd_connection = self._probe_and_connect()
+                    if buckd_connection is None:
                         self.launch_buckd(buck_version_uid=buck_version_uid)
                 elif use_buckd and not has_watchman:
                     print("Not using buckd because watchman isn't installed.",
@@ -158,50 +237,64 @@ class BuckTool(object):
                     print("Not using buckd because NO_BUCKD is set.",
                           file=sys.stderr)
 
-            env = self._environ_for_buck()
-            env['BUCK_BUILD_ID'] = build_id
-
-            buck_socket_path = self._buck_project.get_buckd_socket_path()
+            if use_buckd and buckd_connection is None:
+                buckd_connection = self._probe_and_connect()
 
-            if use_buckd and self._is_buckd_running() and \
-                    os.path.exists(buck_socket_path):
+            try:
+                env = self._full_environ_for_buck(BUCK_BUILD_ID=build_id)
+            except BaseException:
+                # Don't leave buckd waiting on a connection we'll never use.
+                if buckd_connection is not None:
+                    buckd_connection.socket.close()
+                raise
+
+            if buckd_connection is not None:
                 with Tracing('buck', args={'command': sys.argv[1:]}):
                     exit_code = 2
-                    last_diagnostic_time = 0
+                    last_diagnostic_time = None
+                    backoff = DAEMON_BUSY_INITIAL_BACKOFF_SECONDS
                     while exit_code == 2:
-                        with NailgunConnection('local:.buckd/sock',
-                                               cwd=self._buck_project.root) as c:
-                            now = int(round(time.time() * 1000))
-                            env['BUCK_PYTHON_SPACE_INIT_TIME'] = str(now - self._init_timestamp)
+                        # Nailgun serves exactly one command per connection, so
+                        # each retry needs a fresh one.
+                        if buckd_connection is None:
+                            buckd_connection = _FastNailgunConnection(
+                                'local:.buckd/sock', cwd=self._buck_project.root)
+                        with buckd_connection as c:
+                            env['BUCK_PYTHON_SPACE_INIT_TIME'] = \
+                                self._python_space_init_time_millis()
                             exit_code = c.send_command(
                                 'com.facebook.buck.cli.Main',
                                 sys.argv[1:],
                                 env=env,
                                 cwd=self._buck_project.root)
-                            if exit_code == 2:
-                                env['BUCK_BUILD_ID'] = str(uuid.uuid4())
-                                now = time.time()
-                                if now - last_diagnostic_time > DAEMON_BUSY_MESSAGE_SECONDS:
-                                    print('Daemon is busy, waiting for it to become free...',
-                                          file=sys.stderr)
-                                    last_diagnostic_time = now
-                                time.sleep(1)
+                        buckd_connection = None
+                        if exit_code == 2:
+                            import uuid
+                            env['BUCK_BUILD_ID'] = str(uuid.uuid4())
+                            now = monotonic_time_nanos()
+                            if last_diagnostic_time is None or \
+                                    now - last_diagnostic_time > \
+                                    DAEMON_BUSY_MESSAGE_SECONDS * NSEC_PER_SEC:
+                                print('Daemon is busy, waiting for it to become free...',
+                                      file=sys.stderr)
+                                last_diagnostic_time = now
+                            time.sleep(backoff)
+                            backoff = min(backoff * 2, DAEMON_BUSY_MESSAGE_SECONDS)
                     return exit_code
 
-
             command = ["buck"]
             extra_default_options = [
-                "-Djava.io.tmpdir={0}".format(self._tmp_dir)
+                "-Djava.io.tmpdir=%s" % self._tmp_dir
             ]
-            command.extend(self._get_java_args(buck_version_uid, extra_default_options))
+            command.extend(self._get_java_args(
+                self._get_cached_buck_version_uid(), extra_default_options))
             command.append("com.facebook.buck.cli.bootstrapper.ClassLoaderBootstrapper")
             command.append("com.facebook.buck.cli.Main")
             command.extend(sys.argv[1:])
 
-            now = int(round(time.time() * 1000))
-            env['BUCK_PYTHON_SPACE_INIT_TIME'] = str(now - self._init_timestamp)
+            env['BUCK_PYTHON_SPACE_INIT_TIME'] = self._python_space_init_time_millis()
             if True:
-                java = which("java")
+                java = _cached_which("java")
                 if java is None:
                     raise BuckToolException('Could not find java on $PATH')
                 with Tracing('buck', args={'command': command}):
@@ -223,12 +316,11 @@ class BuckTool(object):
         return new_logs
 
     def _generate_log_entry(self, exit_code, message, logs_array):
-        import socket
         import getpass
         traits = {
             "severity": "SEVERE",
             "logger": "com.facebook.buck.python.buck_tool.py",
-            "buckGitCommit": self._get_buck_version_uid(),
+            "buckGitCommit": self._get_cached_buck_version_uid(),
             "os": platform.system(),
             "osVersion": platform.release(),
             "user": getpass.getuser(),
@@ -250,7 +342,7 @@ class BuckTool(object):
         with Tracing('BuckTool.launch_buckd'):
             self._setup_watchman_watch()
             if buck_version_uid is None:
-                buck_version_uid = self._get_buck_version_uid()
+                buck_version_uid = self._get_cached_buck_version_uid()
             # Override self._tmp_dir to a long lived directory.
             buckd_tmp_dir = self._buck_project.create_buckd_tmp_dir()
             ngserver_output_path = os.path.join(buckd_tmp_dir, 'ngserver-out')
@@ -265,8 +357,8 @@ class BuckTool(object):
             '''
             command = ["buckd"]
             extra_default_options = [
-                "-Dbuck.buckd_launch_time_nanos={0}".format(monotonic_time_nanos()),
-                "-XX:MaxGCPauseMillis={0}".format(GC_MAX_PAUSE_TARGET),
+                "-Dbuck.buckd_launch_time_nanos=%s" % monotonic_time_nanos(),
+                "-XX:MaxGCPauseMillis=%s" % GC_MAX_PAUSE_TARGET,
                 "-XX:SoftRefLRUPolicyMSPerMB=0",
                 # Stop Java waking up every 50ms to collect thread
                 # statistics; doing it once every five seconds is much
@@ -278,9 +370,9 @@ class BuckTool(object):
                 # there's some rebalancing to be done is silly.
                 "-XX:+UnlockDiagnosticVMOptions",
                 "-XX:GuaranteedSafepointInterval=5000",
-                "-Djava.io.tmpdir={0}".format(buckd_tmp_dir),
-                "-Dcom.martiansoftware.nailgun.NGServer.outputPath={0}".format(
-                    ngserver_output_path),
+                "-Djava.io.tmpdir=%s" % buckd_tmp_dir,
+                "-Dcom.martiansoftware.nailgun.NGServer.outputPath=%s" %
+                    ngserver_output_path,
                 "-XX:+UseG1GC",
                 "-XX:MaxHeapFreeRatio=40",
             ]
@@ -289,21 +381,8 @@ class BuckTool(object):
             command.append("com.facebook.buck.cli.bootstrapper.ClassLoaderBootstrapper")
             command.append("com.facebook.buck.cli.Main$DaemonBootstrap")
             command.append("local:.buckd/sock")
-            command.append("{0}".format(BUCKD_CLIENT_TIMEOUT_MILLIS))
+            command.append(str(BUCKD_CLIENT_TIMEOUT_MILLIS))
 
-            '''
-            Change the process group of the child buckd process so that when this
-            script is interrupted, it does not kill buckd.
-            '''
-            def preexec_func():
-                # Close any open file descriptors to further separate buckd from its
-                # invoking context (e.g. otherwise we'd hang when running things like
-                # `ssh localhost buck clean`).
-                dev_null_fd = os.open("/dev/null", os.O_RDWR)
-                os.dup2(dev_null_fd, 0)
-                os.dup2(dev_null_fd, 1)
-                os.dup2(dev_null_fd, 2)
-                os.close(dev_null_fd)
             buck_socket_path = self._buck_project.get_buckd_socket_path()
 
             # Make sure the Unix domain socket doesn't exist before this call.
@@ -316,20 +395,30 @@ class BuckTool(object):
                 else:
                     raise e
 
-            process = subprocess.Popen(
-                command,
-                executable=which("java"),
-                cwd=self._buck_project.root,
-                close_fds=True,
-                preexec_fn=preexec_func,
-                env=self._environ_for_buck())
-
-            self._buck_project.save_buckd_version(buck_version_uid)
-
-            # Give Java some time to create the listening socket.
-            for i in range(0, 300):
-                if not os.path.exists(buck_socket_path):
-                    time.sleep(0.01)
+            # Start watching for the socket before launching Java so that we
+            # can't miss its creation.
+            with PathWatcher(buck_socket_path) as socket_watcher:
+                # Point buckd's standard streams at /dev/null and close any other
+                # open file descriptors to separate it from its invoking context
+                # (e.g. otherwise we'd hang when running things like
+                # `ssh localhost buck clean`).  This is done with plain Popen
+                # arguments rather than a preexec_fn, which would have to run
+                # Python code in the forked child.
+                with open(os.devnull, 'r+') as dev_null:
+                    process = subprocess.Popen(
+                        command,
+                        executable=_cached_which("java"),
+                        cwd=self._buck_project.root,
+                        stdin=dev_null,
+                        stdout=dev_null,
+                        stderr=dev_null,
+                        close_fds=True,
+                        env=self._full_environ_for_buck())
+
+                self._buck_project.save_buckd_version(buck_version_uid)
+
+                # Give Java some time to create the listening socket.
+                socket_watcher.wait(BUCKD_SOCKET_TIMEOUT_SECONDS)
 
             returncode = process.poll()
 
@@ -345,7 +434,8 @@ class BuckTool(object):
             if os.path.exists(buckd_socket_path):
                 print("Shutting down nailgun server...", file=sys.stderr)
                 try:
-                    with NailgunConnection('local:.buckd/sock', cwd=self._buck_project.root) as c:
+                    with _FastNailgunConnection('local:.buckd/sock',
+                                                cwd=self._buck_project.root) as c:
                         c.send_command('ng-stop')
                 except NailgunException as e:
                     if e.code not in (NailgunException.CONNECT_FAILED,
@@ -359,7 +449,8 @@ class BuckTool(object):
 
     def _setup_watchman_watch(self):
         with Tracing('BuckTool._setup_watchman_watch'):
-            if not which('watchman'):
+            if not _cached_which('watchman'):
+                import textwrap
                 message = textwrap.dedent("""\
                     Watchman not found, please install when using buckd.
                     See https://github.com/facebook/watchman for details.""")
@@ -371,34 +462,45 @@ class BuckTool(object):
 
             print("Using watchman.", file=sys.stderr)
 
-    def _is_buckd_running(self):
-        with Tracing('BuckTool._is_buckd_running'):
+    # Connect to buckd, returning the connection to send the actual command
+    # over, or None if buckd isn't running.  This doubles as the liveness check
+    # so that a warm invocation costs no extra round trip.
+    def _probe_and_connect(self):
+        with Tracing('BuckTool._probe_and_connect'):
             buckd_socket_path = self._buck_project.get_buckd_socket_path()
 
             if not os.path.exists(buckd_socket_path):
-                return False
+                return None
 
             try:
-                with NailgunConnection(
-                        'local:.buckd/sock',
-                        stdin=None,
-                        stdout=None,
-                        stderr=None,
-                        cwd=self._buck_project.root) as c:
-                    c.send_command('ng-stats')
+                return _FastNailgunConnection('local:.buckd/sock', cwd=self._buck_project.root)
             except NailgunException as e:
                 if e.code == NailgunException.CONNECT_FAILED:
-                    return False
+                    return None
                 else:
                     raise
-            return True
+
+    def _get_cached_buck_version_uid(self):
+        if self._buck_version_uid is None:
+            self._buck_version_uid = self._get_buck_version_uid()
+        return self._buck_version_uid
 
     def _get_buck_version_uid(self):
         raise NotImplementedError()
 
+    def _get_cached_bootstrap_classpath(self):
+        if self._bootstrap_classpath is None:
+            self._bootstrap_classpath = self._get_bootstrap_classpath()
+        return self._bootstrap_classpath
+
     def _get_bootstrap_classpath(self):
         raise NotImplementedError()
 
+    def _get_cached_java_classpath(self):
+        if self._java_classpath is None:
+            self._java_classpath = self._get_java_classpath()
+        return self._java_classpath
+
     def _get_java_classpath(self):
         raise NotImplementedError()
 
@@ -408,27 +510,38 @@ class BuckTool(object):
     def _get_extra_java_args(self):
         return []
 
+    # Getting a resource may unpack it, so the exported resource arguments are
+    # only computed once per process.
+    def _get_cached_exported_resource_args(self):
+        if self._exported_resource_args is None:
+            self._exported_resource_args = self._get_exported_resource_args()
+        return self._exported_resource_args
+
+    # System properties pointing buck at the exported resources.
+    def _get_exported_resource_args(self):
+        return [
+            "-Dbuck.%s=%s" % (resource.name, self._get_resource(resource))
+            for resource in EXPORTED_RESOURCES
+            if self._has_resource(resource)
+        ]
+
     def _get_java_args(self, version_uid, extra_default_options=[]):
         with Tracing('BuckTool._get_java_args'):
             java_args = [
-                "-Xmx{0}m".format(JAVA_MAX_HEAP_SIZE_MB),
+                "-Xmx%sm" % JAVA_MAX_HEAP_SIZE_MB,
                 "-Djava.awt.headless=true",
                 "-Djava.util.logging.config.class=com.facebook.buck.cli.bootstrapper.LogConfig",
                 "-Dbuck.test_util_no_tests_dir=true",
-                "-Dbuck.version_uid={0}".format(version_uid),
-                "-Dbuck.buckd_dir={0}".format(self._buck_project.buckd_dir),
+                "-Dbuck.version_uid=%s" % version_uid,
+                "-Dbuck.buckd_dir=%s" % self._buck_project.buckd_dir,
                 "-Dorg.eclipse.jetty.util.log.class=org.eclipse.jetty.util.log.JavaUtilLog",
             ]
 
             resource_lock_path = self._get_resource_lock_path()
             if resource_lock_path is not None:
-                java_args.append("-Dbuck.resource_lock_path={0}".format(resource_lock_path))
+                java_args.append("-Dbuck.resource_lock_path=%s" % resource_lock_path)
 
-            for resource in EXPORTED_RESOURCES:
-                if self._has_resource(resource):
-                    java_args.append(
-                        "-Dbuck.{0}={1}".format(
-                            resource.name, self._get_resource(resource)))
+            java_args.extend(self._get_cached_exported_resource_args())
 
             if sys.platform == "darwin":
                 java_args.append("-Dbuck.enable_objc=true")
@@ -436,11 +549,11 @@ class BuckTool(object):
                     self._get_resource(
                         Resource("libjcocoa.dylib"))))
 
-            if os.environ.get("BUCK_DEBUG_MODE"):
+            if _BUCK_DEBUG_MODE:
                 java_args.append("-agentlib:jdwp=transport=dt_socket,"
                                  "server=y,suspend=y,address=8888")
 
-            if os.environ.get("BUCK_DEBUG_SOY"):
+            if _BUCK_DEBUG_SOY:
                 java_args.append("-Dbuck.soy.debug=true")
 
             java_args.extend(extra_default_options)
@@ -453,19 +566,14 @@ class BuckTool(object):
 
             java_args.extend(self._get_extra_java_args())
 
-            extra_java_args = os.environ.get("BUCK_EXTRA_JAVA_ARGS")
-            if extra_java_args:
-                java_args.extend(shlex.split(extra_java_args))
+            if _BUCK_EXTRA_JAVA_ARGS:
+                java_args.extend(shlex.split(_BUCK_EXTRA_JAVA_ARGS))
             return java_args
 
-    def _platform_path(self, path):
-        if sys.platform != 'cygwin':
-            return path
-        return subprocess.check_output(['cygpath', '-w', path]).strip()
-
 
 def install_signal_handlers():
     if os.name == 'posix':
-        signal.signal(
-            signal.SIGUSR1,
-            lambda sig, frame: traceback.print_stack(frame))
+        def print_stack(sig, frame):
+            import traceback
+            traceback.print_stack(frame)
+        signal.signal(signal.SIGUSR1, print_stack)
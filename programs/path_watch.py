@@ -0,0 +1,179 @@
+# Copyright 2016-present Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import ctypes
+import errno
+import os
+import platform
+import select
+import sys
+import time
+
+from timing import monotonic_time_nanos, NSEC_PER_SEC
+
+
+# How long to sleep between existence checks when no filesystem event
+# notification mechanism is available.
+POLL_INTERVAL_SECONDS = 0.001
+
+# Even with event notification, re-check the path this often in case an
+# event was missed (e.g. the directory was replaced underneath the watch).
+EVENT_RECHECK_SECONDS = 0.005
+
+
+def _fs_path(path):
+    if not isinstance(path, bytes):
+        path = path.encode(sys.getfilesystemencoding())
+    return path
+
+
+# Python 2 doesn't retry system calls interrupted by a signal (e.g. the
+# SIGUSR1 handler buck installs).  The caller re-checks the path anyway, so
+# treat an interruption like a timeout.
+def _ignore_eintr(e):
+    if e.args[0] != errno.EINTR:
+        raise e
+
+
+class _PollWatch(object):
+    def wait_for_event(self, timeout_secs):
+        time.sleep(min(timeout_secs, POLL_INTERVAL_SECONDS))
+
+    def close(self):
+        pass
+
+
+if platform.system() == 'Linux':
+    # From <sys/inotify.h>
+    IN_CLOEXEC = 0x80000
+    IN_NONBLOCK = 0x800
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+        inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        inotify_init1 = None
+
+    class _InotifyWatch(object):
+        def __init__(self, directory):
+            self._fd = inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+            if self._fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if inotify_add_watch(self._fd, _fs_path(directory), IN_CREATE | IN_MOVED_TO) < 0:
+                err = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(err, 'inotify_add_watch failed')
+
+        def wait_for_event(self, timeout_secs):
+            try:
+                readable, _, _ = select.select([self._fd], [], [], timeout_secs)
+            except select.error as e:
+                _ignore_eintr(e)
+                return
+            if readable:
+                # Drain the queued events; the caller re-checks the path itself.
+                try:
+                    while os.read(self._fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+        def close(self):
+            os.close(self._fd)
+
+    def _make_native_watch(directory):
+        if inotify_init1 is None:
+            return None
+        return _InotifyWatch(directory)
+
+elif hasattr(select, 'kqueue'):
+    # O_EVTONLY from <sys/fcntl.h> on Darwin; plain O_RDONLY elsewhere.
+    _O_EVTONLY = 0x8000 if platform.system() == 'Darwin' else os.O_RDONLY
+
+    class _KqueueWatch(object):
+        def __init__(self, directory):
+            self._dir_fd = os.open(directory, _O_EVTONLY)
+            try:
+                self._kq = select.kqueue()
+            except Exception:
+                os.close(self._dir_fd)
+                raise
+            self._kq.control([select.kevent(
+                self._dir_fd,
+                filter=select.KQ_FILTER_VNODE,
+                flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                fflags=select.KQ_NOTE_WRITE)], 0, 0)
+
+        def wait_for_event(self, timeout_secs):
+            try:
+                self._kq.control(None, 1, timeout_secs)
+            except (OSError, IOError) as e:
+                _ignore_eintr(e)
+
+        def close(self):
+            self._kq.close()
+            os.close(self._dir_fd)
+
+    def _make_native_watch(directory):
+        return _KqueueWatch(directory)
+
+else:
+    def _make_native_watch(directory):
+        return None
+
+
+class PathWatcher(object):
+    '''Waits for a path to be created, without busy-polling where possible.
+
+    The watch is armed on construction, so create the watcher before
+    starting whatever is expected to create the path; otherwise the
+    creation event may be missed (it is still caught by the periodic
+    re-check, just later).
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        try:
+            self._watch = _make_native_watch(os.path.dirname(path))
+        except (OSError, IOError):
+            self._watch = None
+        if self._watch is None:
+            self._watch = _PollWatch()
+
+    def wait(self, timeout_secs):
+        '''Blocks until the path exists or timeout_secs elapses.
+
+        Returns whether the path exists.
+        '''
+        deadline = monotonic_time_nanos() + int(timeout_secs * NSEC_PER_SEC)
+        while not os.path.exists(self._path):
+            remaining = float(deadline - monotonic_time_nanos()) / NSEC_PER_SEC
+            if remaining <= 0:
+                return False
+            self._watch.wait_for_event(min(remaining, EVENT_RECHECK_SECONDS))
+        return True
+
+    def close(self):
+        self._watch.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,73 @@
+# Copyright 2016-present Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+from path_watch import PathWatcher
+
+
+class TestPathWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_existing_path(self):
+        open(self.path, 'w').close()
+        with PathWatcher(self.path) as watcher:
+            self.assertTrue(watcher.wait(0))
+
+    def test_path_created_later(self):
+        with PathWatcher(self.path) as watcher:
+            timer = threading.Timer(0.05, lambda: open(self.path, 'w').close())
+            timer.start()
+            try:
+                self.assertTrue(watcher.wait(5))
+            finally:
+                timer.join()
+
+    def test_timeout(self):
+        with PathWatcher(self.path) as watcher:
+            self.assertFalse(watcher.wait(0.02))
+
+    def test_missing_directory(self):
+        path = os.path.join(self.tmp_dir, 'missing', 'sock')
+        with PathWatcher(path) as watcher:
+            self.assertFalse(watcher.wait(0.02))
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'requires SIGUSR1')
+    def test_interrupted_by_signal(self):
+        previous_handler = signal.signal(signal.SIGUSR1, lambda sig, frame: None)
+        try:
+            with PathWatcher(self.path) as watcher:
+                timer = threading.Timer(
+                    0.02, lambda: os.kill(os.getpid(), signal.SIGUSR1))
+                timer.start()
+                try:
+                    self.assertFalse(watcher.wait(0.2))
+                finally:
+                    timer.join()
+        finally:
+            signal.signal(signal.SIGUSR1, previous_handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,7 @@ def monotonic_time_nanos():
 
 
 NSEC_PER_SEC = 1000000000
+NSEC_PER_MSEC = 1000000
 
 
 def set_posix_time_nanos(clock_gettime, clock_id):